@@ -1,36 +1,76 @@
-from asyncio import get_running_loop
+from asyncio import (
+    Semaphore,
+    create_task,
+    gather,
+    get_running_loop,
+    shield,
+    sleep,
+)
+from codecs import getincrementaldecoder
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
 from datetime import datetime,timezone
 from errno import ENOTEMPTY
 from functools import partial
-from jinja2 import Environment,ChoiceLoader,FileSystemLoader,PackageLoader
+from heapq import nlargest
+from hashlib import blake2b,sha256
+from jinja2 import (
+    Environment,
+    ChoiceLoader,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    PackageLoader,
+)
 from logging import getLogger
 from pathlib import Path
+from re import compile as regex
 from shutil import rmtree
 from starlette.applications import Starlette
 from starlette.datastructures import ImmutableMultiDict
 from starlette.middleware import Middleware
-from starlette.responses import Response
+from starlette.responses import JSONResponse,Response,StreamingResponse
 from starlette.routing import Route
-from tempfile import mkdtemp
+from time import perf_counter
+from types import SimpleNamespace
 from urllib.parse import unquote
 from x509middleware.asgi import ClientCertificateMiddleware
 
+from . import metrics
 from .config import *
 from .exceptions import (
     BadRequest,
+    Conflict,
     InternalServerError,
     ServiceUnavailable,
 )
 from .jinja2 import *
 from .state import State
+from .store import BlobSources,BlobStore
 from .util import (
+    LRUCache,
+    SharedIterator,
+    compress,
+    compress_chunks,
+    encode_chunks,
+    etag_matches,
+    iterate_threaded,
+    make_etag,
+    make_tar,
+    multidict_key,
+    negotiate_encoding,
+    read_manifest,
     requires_client_name,
     resolve_relative,
     tariter,
+    time_iterator,
+    update_hash,
 )
 
 log = getLogger(__name__)
 
+MANIFEST_NAME = Path('.thincf-manifest')
+LOAD_BATCH_SIZE = 64
+BLOB_DIGEST = regex(r'^[0-9a-f]{64}$')
+
 class ThincfServer(Starlette):
     async def execute(self, func, *args, **kws):
         return await get_running_loop().run_in_executor(
@@ -39,10 +79,29 @@ class ThincfServer(Starlette):
 
     @requires_client_name
     async def upload_state(self, request, client_name):
-        tmp = Path(await self.execute(mkdtemp, dir=STATEDIR))
+        # a delta upload only carries the files changed since the base
+        # state plus a manifest of the complete tree; it has to be based
+        # on the current state for its parsed files to be reused
+        base = None
+        if (base_identifier := request.headers.get('thincf-base')) is not None:
+            if (base := self.state.state) is None \
+                    or base.identifier != base_identifier:
+                raise Conflict(
+                    f"Base state '{base_identifier}' is not current."
+                )
+
+        store = self.state.store
+        start = perf_counter()
 
         async def iterate_stream():
-            async for tarinfo,data in tariter(request.stream()):
+            manifest = None
+            uploaded = {}
+
+            async for tarinfo,chunks in tariter(
+                    request.stream(),
+                    chunk_size = UPLOAD_CHUNK_SIZE,
+                    max_inflight = UPLOAD_MAX_INFLIGHT,
+                    max_file_size = UPLOAD_MAX_FILE_SIZE):
                 if tarinfo.isdir():
                     continue
 
@@ -56,44 +115,130 @@ class ThincfServer(Starlette):
                         f"File '{tarinfo.name}' points outside of root."
                     )
 
-                yield name,data.decode('utf8')
-                filename = tmp / name
-                await self.execute(filename.parent.mkdir, parents=True, exist_ok=True)
-                await self.execute(filename.write_bytes, data)
+                if name == MANIFEST_NAME:
+                    if base is None:
+                        raise BadRequest(
+                            f"Manifest requires a base state."
+                        )
+                    manifest = read_manifest(
+                        b''.join([chunk async for chunk in chunks])
+                            .decode('utf8')
+                    )
+                    continue
+
+                # store the file as its chunks come in while decoding
+                # them for the state
+                writer = await self.execute(store.writer)
+                decoder = getincrementaldecoder('utf8')()
+                content = []
 
-        try:
-            state = await State.from_iterator(
-                datetime.now(timezone.utc).astimezone().isoformat(
-                    timespec='microseconds'
-                ),
-                iterate_stream(),
-            )
+                try:
+                    async for chunk in chunks:
+                        await self.execute(writer.write, chunk)
+                        content.append(decoder.decode(chunk))
+                        metrics.UPLOAD_BYTES.inc(len(chunk))
+                    content.append(decoder.decode(b'', final=True))
+                    uploaded[name] = await self.execute(writer.commit)
+                except:
+                    await self.execute(writer.abort)
+                    raise
+
+                yield name,''.join(content),uploaded[name]
+
+            if base is None:
+                return
 
-            await self.execute(tmp.rename, STATEDIR / state.identifier)
+            if manifest is None:
+                raise BadRequest(f"Manifest missing.")
+
+            for name,digest in uploaded.items():
+                if manifest.get(name) != digest:
+                    raise BadRequest(
+                        f"File '{name}' doesn't match manifest."
+                    )
+
+            # everything else is unchanged and already in the store
+            for name,digest in manifest.items():
+                if name not in uploaded:
+                    await self.execute(store.hold, digest)
+                    yield name,None,digest
+
+        identifier = datetime.now(timezone.utc).astimezone().isoformat(
+            timespec='microseconds'
+        )
+
+        try:
+            with await self.execute(store.transaction):
+                state = await State.from_iterator(
+                    identifier,
+                    iterate_stream(),
+                    self.state.compiler,
+                    await self.execute(self.bytecode_cache, identifier),
+                    base,
+                )
+                await self.execute(
+                    store.write_manifest, state.identifier, state.digests,
+                )
 
         except Exception as exc:
-            await self.execute(rmtree, tmp)
+            await self.execute(
+                rmtree, self.bytecode_cache_dir(identifier), ignore_errors=True
+            )
             log.warn('Error importing state', exc_info=True)
             raise BadRequest(f"Submitted state is invalid: {exc}")
 
+        metrics.UPLOAD_SECONDS.observe(perf_counter() - start)
+
+        # other workers pick the new state up through the pointer; the one
+        # served so far is known to load and stays around to fall back to
+        self.release_sources(state)
+        previous = self.state.state
         self.state.state = state
+
+        if previous is not None and previous.identifier != state.identifier:
+            await self.execute(
+                store.write_pointer, store.LAST_GOOD, previous.identifier,
+            )
+        await self.execute(store.write_pointer, store.CURRENT, state.identifier)
+
+        if PRERENDER:
+            self.prerender(state)
+
+        self.collect_garbage()
         return Response(status_code=201)
 
+    @requires_client_name
+    async def compare_manifest(self, request, client_name):
+        if (state := self.state.state) is None:
+            raise ServiceUnavailable(f"No state installed.")
+
+        try:
+            manifest = read_manifest((await request.body()).decode('utf8'))
+        except ValueError as exc:
+            raise BadRequest(f"Submitted manifest is invalid: {exc}")
+
+        # answer with the files the current state lacks; the uploader
+        # sends those along with the manifest and this state as its base
+        return Response(
+            ''.join(
+                f'{name}\n' for name,digest in manifest.items()
+                if state.digests.get(name) != digest
+            ),
+            media_type='text/plain',
+            headers={ 'thincf-base': state.identifier },
+        )
+
     @requires_client_name
     async def get_script(self, request, client_name):
         # commandline arguments passed to client
         if not (args := request.headers.getlist('thincf-args')):
             raise BadRequest(f'Client commandline arguments missing.')
 
-        # parse environment headers
-        env = ImmutableMultiDict(
-            (key, unquote(part.strip(), errors='surrogateescape'))
-            for (b,s,key),val in (
-                (key.partition('thincf-env-'),val)
-                for key,val in request.headers.items()
-            ) if not b
-            for part in val.split(',')
-        )
+        env = self.parse_env(request)
+
+        # clients keeping a blob cache get file contents by digest
+        # rather than inlined into the script
+        blobs = request.headers.get('thincf-blobs') == '1'
 
         # list of states client knows about
         states = [
@@ -111,32 +256,390 @@ class ThincfServer(Starlette):
         if (host := state.find_host(client_name=client_name)) is None:
             raise ServiceUnavailable(f"Client '{client_name}' unknown.")
 
-        # set up arguments and parser
-        args = [
+        # set up arguments
+        args = tuple(
             unquote(arg.strip(), errors='surrogateescape')
             for part in args for arg in part.split(',')
-        ]
-        argparser = ArgumentParserContext(args.pop(0), args)
+        )
+
+        encoding = negotiate_encoding(
+            request.headers.get('accept-encoding', '')
+        )
+
+        # remembered for pre-rendering this host's script after uploads
+        self.state.seen[host.name] = (args, env, blobs)
+
+        # everything the response depends on is known at this point, so
+        # a client still having the current script gets away without
+        # any evaluation or rendering
+        etag = make_etag(
+            self.state.version, state.identifier, host.name, args,
+            multidict_key(env), sorted(states), encoding, blobs,
+        )
+
+        if etag_matches(request.headers.get('if-none-match', ''), etag):
+            return Response(status_code=304, headers={ 'etag': etag })
 
         try:
-            tmpl = self.state.jinja.get_template('main')
-            body = tmpl.render(
-                state = state.evaluate(host, states, env),
-                argparser = argparser,
-                env = env,
+            # evaluation is cached per host; if the client already knows
+            # the resulting state there's nothing left to install and the
+            # script no longer depends on the host at all
+            result = await self.execute(
+                state.evaluate, host, env, self.state.evaluator,
             )
-            return Response(
-                body,
-                media_type='text/plain',
-                headers={ 'thincf-shell': 'sh' },
+            identifier = result['identifier']
+
+            if known := identifier in states:
+                result = None
+
+            key = (
+                self.state.version,
+                None if known else identifier,
+                args,
+                multidict_key(env),
+                blobs,
             )
 
+            headers = {
+                'etag': etag,
+                'thincf-shell': 'sh',
+                'thincf-state': identifier,
+                'thincf-state-status': 'known' if known else 'new',
+                'vary': 'accept-encoding',
+            }
+
+            if encoding is not None:
+                headers['content-encoding'] = encoding
+
+            # join a pre-render of this very script that's still running
+            if (rendering := self.state.rendering.get(key)) is not None:
+                await shield(rendering)
+
+            # cached scripts keep each encoding they have been sent in
+            if (bodies := self.state.scripts.get(key)) is not None:
+                if encoding not in bodies:
+                    bodies[encoding] = await self.execute(
+                        compress, bodies[None], encoding
+                    )
+                metrics.RESPONSE_BYTES.observe(
+                    len(bodies[encoding]), encoding=encoding or 'identity',
+                )
+                return Response(
+                    bodies[encoding],
+                    media_type='text/plain',
+                    headers=headers,
+                )
+
+            # render in a thread and stream the result; identical requests
+            # coming in meanwhile share that render as long as it's small
+            # enough for the script cache, otherwise they render their own
+            if (flight := self.state.flights.get((key, encoding))) is None:
+                flight = self.state.flights[key, encoding] = SharedIterator(
+                    self.render_chunks(result, args, env, blobs, encoding),
+                    SCRIPT_CACHE_MAX_BYTES,
+                    sizeof=lambda chunks: sum(map(len, chunks)),
+                )
+                flight.task.add_done_callback(
+                    partial(self.land_flight, key, encoding, flight)
+                )
+
+            if flight.joinable:
+                chunks = flight.replay()
+            else:
+                chunks = self.render_chunks(result, args, env, blobs, encoding)
+
+            # wait for the first chunk so early errors can still be
+            # reported properly
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = (b'', b'')
+
         except Exception as exc:
             log.warn('Error rendering template', exc_info=True)
             raise InternalServerError(
                 f"Error generating script.\n  {exc.__class__.__name__}: {exc}"
             )
 
+        return StreamingResponse(
+            self.stream_script(first, chunks, encoding),
+            media_type='text/plain',
+            headers=headers,
+        )
+
+    async def stream_script(self, first, chunks, encoding):
+        # an error at this point can only abort the connection, which the
+        # client notices because the script's closing brace is missing
+        size = len(first[1])
+
+        try:
+            if first[1]:
+                yield first[1]
+
+            async for raw,compressed in chunks:
+                if compressed:
+                    size += len(compressed)
+                    yield compressed
+
+        except Exception:
+            log.warn('Error rendering template', exc_info=True)
+            raise
+
+        finally:
+            await chunks.aclose()
+
+        metrics.RESPONSE_BYTES.observe(size, encoding=encoding or 'identity')
+
+    def land_flight(self, key, encoding, flight, task):
+        # the flight only kept its chunks if they fit into the cache
+        del self.state.flights[key, encoding]
+
+        if flight.error is not None or not flight.kept or not flight.items:
+            return
+
+        raw,compressed = zip(*flight.items)
+        self.state.scripts[key] = {
+            None: b''.join(raw),
+            encoding: b''.join(compressed),
+        }
+
+    # the render is timed in its thread, leaving out the time spent
+    # waiting for the clients to take the chunks
+    def render_chunks(self, result, args, env, blobs, encoding):
+        return iterate_threaded(
+            compress_chunks(
+                time_iterator(
+                    encode_chunks(
+                        self.generate_script(result, args, env, blobs),
+                        STREAM_CHUNK_SIZE,
+                    ),
+                    metrics.RENDER_SECONDS.observe,
+                ),
+                encoding,
+            ),
+        )
+
+    @requires_client_name
+    async def get_blobs(self, request, client_name):
+        if (state := self.state.state) is None:
+            raise ServiceUnavailable(f"No state installed.")
+
+        if (host := state.find_host(client_name=client_name)) is None:
+            raise ServiceUnavailable(f"Client '{client_name}' unknown.")
+
+        digests = (await request.body()).decode('utf8').split()
+
+        for digest in digests:
+            if BLOB_DIGEST.match(digest) is None:
+                raise BadRequest(f"Invalid digest '{digest}'.")
+
+        # contents are only handed out to hosts whose state has them, so
+        # they're looked up in the evaluation for the requesting host
+        result = await self.execute(
+            state.evaluate, host, self.parse_env(request),
+            self.state.evaluator,
+        )
+
+        if (identifier := request.headers.get('thincf-state')) is not None \
+                and identifier != result['identifier']:
+            raise Conflict(f"State {identifier} no longer current.")
+
+        contents = {
+            entry.digest: entry.data
+            for entry in result['entries'] if entry.type == 'file'
+        }
+
+        if missing := [ d for d in digests if d not in contents ]:
+            raise BadRequest(f"Unknown blobs: {' '.join(missing)}")
+
+        encoding = negotiate_encoding(
+            request.headers.get('accept-encoding', '')
+        )
+        body = await self.execute(
+            make_tar, ((digest, contents[digest]) for digest in digests)
+        )
+        headers = { 'vary': 'accept-encoding' }
+
+        if encoding is not None:
+            body = await self.execute(compress, body, encoding)
+            headers['content-encoding'] = encoding
+
+        metrics.RESPONSE_BYTES.observe(
+            len(body), encoding=encoding or 'identity',
+        )
+        return Response(
+            body, media_type='application/x-tar', headers=headers,
+        )
+
+    def parse_env(self, request):
+        return ImmutableMultiDict(
+            (key, unquote(part.strip(), errors='surrogateescape'))
+            for (b,s,key),val in (
+                (key.partition('thincf-env-'),val)
+                for key,val in request.headers.items()
+            ) if not b
+            for part in val.split(',')
+        )
+
+    def generate_script(self, result, args, env, blobs=False):
+        return self.state.jinja.get_template('main').generate(
+            state = result,
+            argparser = ArgumentParserContext(args[0], list(args[1:])),
+            env = env,
+            blobs = blobs,
+        )
+
+    def render_script(self, result, args, env, blobs=False):
+        with metrics.RENDER_SECONDS.time():
+            return ''.join(
+                self.generate_script(result, args, env, blobs)
+            ).encode('utf8')
+
+    # evaluates and renders the script of every host that has been seen
+    # before, using the arguments and environment it last polled with;
+    # polls for a script still being rendered wait for it to finish
+    def prerender(self, state):
+        job = self.state.prerender = SimpleNamespace(
+            identifier = state.identifier,
+            hosts = len(state.hosts),
+            rendered = 0,
+            skipped = 0,
+            failed = 0,
+            task = None,
+        )
+        semaphore = Semaphore(PRERENDER_CONCURRENCY)
+
+        async def render_host(host):
+            if (seen := self.state.seen.get(host.name)) is None:
+                job.skipped += 1
+                return
+
+            args,env,blobs = seen
+
+            async with semaphore:
+                # no point in going on once the state got replaced
+                if self.state.state is not state:
+                    job.skipped += 1
+                    return
+
+                try:
+                    result = await self.execute(
+                        state.evaluate, host, env, self.state.evaluator,
+                    )
+                    key = (
+                        self.state.version, result['identifier'], args,
+                        multidict_key(env), blobs,
+                    )
+
+                    if key in self.state.rendering \
+                            or self.state.scripts.get(key) is not None:
+                        job.rendered += 1
+                        return
+
+                    rendering = self.state.rendering[key] = \
+                        get_running_loop().create_future()
+
+                    try:
+                        body = await self.execute(
+                            self.render_script, result, args, env, blobs,
+                        )
+                        if len(body) <= SCRIPT_CACHE_MAX_BYTES:
+                            self.state.scripts[key] = { None: body }
+                    finally:
+                        del self.state.rendering[key]
+                        rendering.set_result(None)
+
+                    job.rendered += 1
+
+                except Exception:
+                    job.failed += 1
+                    log.warn(f"Error pre-rendering script for {host.name}",
+                             exc_info=True)
+
+        async def run():
+            await gather(*(
+                render_host(host) for host in state.hosts.values()
+            ))
+
+        job.task = create_task(run())
+
+    @requires_client_name
+    async def get_prerender(self, request, client_name):
+        if (job := self.state.prerender) is None:
+            return JSONResponse(None)
+
+        return JSONResponse({
+            'identifier': job.identifier,
+            'hosts': job.hosts,
+            'rendered': job.rendered,
+            'skipped': job.skipped,
+            'failed': job.failed,
+            'running': not job.task.done(),
+        })
+
+    async def get_metrics(self, request):
+        caches = [ ('script', self.state.scripts) ]
+
+        if (state := self.state.state) is not None:
+            caches.append(('evaluate', state.cache))
+
+        metrics.STATE_INFO.replace(
+            [] if state is None else [({ 'identifier': state.identifier }, 1)]
+        )
+        # per file times are kept by the state, so they start over with
+        # every new one; only the slowest files are worth a series
+        metrics.EVALUATE_FILE_SECONDS_SLOWEST.replace(
+            [] if state is None else (
+                ({ 'path': path }, seconds)
+                for path,seconds in nlargest(
+                    metrics.SLOWEST_FILES, list(state.evaluate_times.items()),
+                    key=lambda item: item[1],
+                )
+            )
+        )
+        metrics.CACHE_HITS.replace(
+            ({ 'cache': name }, cache.hits) for name,cache in caches
+        )
+        metrics.CACHE_MISSES.replace(
+            ({ 'cache': name }, cache.misses) for name,cache in caches
+        )
+        metrics.CACHE_ENTRIES.replace(
+            ({ 'cache': name }, len(cache)) for name,cache in caches
+        )
+        metrics.CACHE_BYTES.replace(
+            ({ 'cache': name }, cache.bytes) for name,cache in caches
+            if cache.sizeof is not None
+        )
+
+        return Response(
+            metrics.expose(),
+            media_type='text/plain; version=0.0.4',
+        )
+
+    def bytecode_cache_dir(self, name):
+        return STATEDIR / '.cache' / name
+
+    def bytecode_cache(self, name):
+        path = self.bytecode_cache_dir(name)
+        path.mkdir(parents=True, exist_ok=True)
+        return FileSystemBytecodeCache(path)
+
+    # scripts depend on the templates as well as the code rendering
+    # them, so a digest of both stands in for a version
+    def script_version(self):
+        h = blake2b(digest_size=20, person=b'thincf.scripts')
+        jinja = self.state.jinja
+
+        for name in sorted(jinja.list_templates()):
+            source,_,_ = jinja.loader.get_source(jinja, name)
+            update_hash(h, name, source)
+
+        package = Path(__file__).parent
+        for path in sorted(package.rglob('*.py')):
+            update_hash(h, path.relative_to(package), path.read_bytes())
+
+        return h.hexdigest()
+
     async def on_startup(self):
         loaders = [PackageLoader(__name__, 'templates')]
 
@@ -145,6 +648,7 @@ class ThincfServer(Starlette):
 
         self.state.jinja = Environment(
             loader = ChoiceLoader(loaders),
+            bytecode_cache = await self.execute(self.bytecode_cache, 'scripts'),
             extensions = (
                 ShellFunctionExtension,
                 ScriptDoExtension,
@@ -154,26 +658,218 @@ class ThincfServer(Starlette):
             line_comment_prefix = '##',
             keep_trailing_newline = True,
         )
+        self.state.version = await self.execute(self.script_version)
 
+        self.state.compiler = (
+            ProcessPoolExecutor(COMPILE_PROCESSES)
+            if COMPILE_PROCESSES > 0 else None
+        )
+        self.state.evaluator = (
+            ThreadPoolExecutor(EVALUATE_THREADS)
+            if EVALUATE_THREADS > 0 else None
+        )
+        self.state.scripts = LRUCache(SCRIPT_CACHE_SIZE, SCRIPT_CACHE_AGE)
         self.state.state = None
 
-        async def iterate_directory(path):
-            for item in path.glob('**/*'):
-                if item.is_file():
-                    yield item.relative_to(path),item.read_text('utf8')
+        self.state.store = store = BlobStore(STATEDIR)
+        self.state.collector = None
+        self.state.watcher = None
+        self.state.prerender = None
+        self.state.rendering = {}
+        self.state.flights = {}
+        self.state.seen = {}
+        await self.execute(store.setup)
 
-        for candidate in sorted(STATEDIR.iterdir(), reverse=True):
+        # the current state is loaded, falling back to the last one known
+        # to be good and then to the newest other manifest; without any
+        # manifests the newest state directory from before the store is used
+        current = await self.execute(store.read_pointer, store.CURRENT)
+        last_good = await self.execute(store.read_pointer, store.LAST_GOOD)
+
+        candidates = [
+            identifier for identifier in dict.fromkeys((current, last_good))
+            if identifier is not None
+        ]
+        candidates.extend([
+            identifier
+            for identifier in reversed(await self.execute(store.identifiers))
+            if identifier not in candidates
+        ][:1])
+
+        for identifier in candidates:
             try:
-                self.state.state = await State.from_iterator(
-                    candidate.name,
-                    iterate_directory(candidate),
-                )
+                self.state.state = await self.load_state(identifier)
             except:
-                log.warn(f"Unable to load state {candidate.name}",
+                log.warn(f"Unable to load state {identifier}",
                          exc_info=True)
             else:
                 break
 
+        # states uploaded before there was a store get imported into it
+        if not candidates \
+                and (legacy := await self.execute(store.legacy_identifiers)):
+            try:
+                self.state.state = await self.import_legacy_state(legacy[-1])
+            except:
+                log.warn(f"Unable to load state {legacy[-1]}", exc_info=True)
+
+        # after falling back the loaded state is the one known to be good
+        if (state := self.state.state) is not None:
+            if current is None:
+                await self.execute(
+                    store.write_pointer, store.CURRENT, state.identifier,
+                )
+            if last_good is None or state.identifier != current:
+                await self.execute(
+                    store.write_pointer, store.LAST_GOOD, state.identifier,
+                )
+
+        self.collect_garbage()
+
+        if STATE_POLL_INTERVAL > 0:
+            self.state.watcher = create_task(self.watch_state())
+
+    async def on_shutdown(self):
+        if (watcher := self.state.watcher) is not None:
+            watcher.cancel()
+
+    async def load_state(self, identifier):
+        store = self.state.store
+        manifest = list(
+            (await self.execute(store.read_manifest, identifier)).items()
+        )
+
+        # read the files in batches spread over the thread pool
+        batches = await gather(*(
+            self.execute(store.read_files, manifest[pos:pos + LOAD_BATCH_SIZE])
+            for pos in range(0, len(manifest), LOAD_BATCH_SIZE)
+        ))
+
+        async def iterate_files():
+            for batch in batches:
+                for item in batch:
+                    yield item
+
+        state = await State.from_iterator(
+            identifier,
+            iterate_files(),
+            self.state.compiler,
+            await self.execute(self.bytecode_cache, identifier),
+        )
+        self.release_sources(state)
+        return state
+
+    async def import_legacy_state(self, identifier):
+        store = self.state.store
+        path = STATEDIR / identifier
+
+        def read_directory():
+            return [
+                (item.relative_to(path), data.decode('utf8'),
+                 sha256(data).hexdigest())
+                for item in path.glob('**/*') if item.is_file()
+                for data in (item.read_bytes(),)
+            ]
+
+        files = await self.execute(read_directory)
+
+        async def iterate_files():
+            for item in files:
+                yield item
+
+        state = await State.from_iterator(
+            identifier,
+            iterate_files(),
+            self.state.compiler,
+            await self.execute(self.bytecode_cache, identifier),
+        )
+
+        with await self.execute(store.transaction):
+            for name,digest in state.digests.items():
+                await self.execute(store.import_file, path / name, digest)
+            await self.execute(
+                store.write_manifest, identifier, state.digests,
+            )
+
+        self.release_sources(state)
+        return state
+
+    def release_sources(self, state):
+        state.files = BlobSources(
+            self.state.store,
+            { path: state.digests[path] for path in state.files },
+        )
+
+    async def watch_state(self):
+        store = self.state.store
+        failed = None
+
+        # hot-swap the state whenever another worker installed a new one
+        while True:
+            await sleep(STATE_POLL_INTERVAL)
+
+            try:
+                identifier = await self.execute(store.read_pointer, store.CURRENT)
+            except Exception:
+                log.warn("Unable to read the state pointer", exc_info=True)
+                continue
+
+            if identifier is None or identifier == failed:
+                continue
+            if (state := self.state.state) is not None \
+                    and state.identifier == identifier:
+                continue
+
+            try:
+                state = await self.load_state(identifier)
+            except Exception:
+                failed = identifier
+                log.warn(f"Unable to load state {identifier}", exc_info=True)
+                continue
+
+            # the pointer might have moved on while loading
+            try:
+                current = await self.execute(store.read_pointer, store.CURRENT)
+            except Exception:
+                log.warn("Unable to read the state pointer", exc_info=True)
+                continue
+
+            if identifier == current:
+                self.state.state = state
+                log.info(f"Switched to state {identifier}")
+
+                if PRERENDER:
+                    self.prerender(state)
+
+    def collect_garbage(self):
+        # one run at a time; whatever an upload leaves behind while
+        # another one is running gets picked up by the next
+        if self.state.collector is not None \
+                and not self.state.collector.done():
+            return
+
+        async def collect():
+            keep = []
+            if (state := self.state.state) is not None:
+                keep.append(state.identifier)
+
+            try:
+                dropped = await self.execute(
+                    self.state.store.collect, STATE_RETENTION, keep,
+                )
+                for identifier in dropped:
+                    await self.execute(
+                        rmtree, self.bytecode_cache_dir(identifier),
+                        ignore_errors=True,
+                    )
+            except Exception:
+                log.warn('Error collecting garbage', exc_info=True)
+            else:
+                if dropped:
+                    log.info(f"Dropped states {', '.join(dropped)}")
+
+        self.state.collector = create_task(collect())
+
     def __init__(self, debug=False):
         middleware = []
 
@@ -191,11 +887,18 @@ class ThincfServer(Starlette):
             routes=[
                 Route('/', self.get_script, methods=['GET']),
                 Route('/', self.upload_state, methods=['POST']),
+                Route('/manifest', self.compare_manifest, methods=['POST']),
+                Route('/blobs', self.get_blobs, methods=['POST']),
+                Route('/prerender', self.get_prerender, methods=['GET']),
+                Route('/metrics', self.get_metrics, methods=['GET']),
             ],
             middleware=middleware,
             on_startup=[
                 self.on_startup,
             ],
+            on_shutdown=[
+                self.on_shutdown,
+            ],
         )
 
 app = ThincfServer(debug=True)
@@ -19,10 +19,44 @@ STATEDIR = exists_and_dir(config, 'THINCF_SERVER_STATEDIR')
 TEMPLATEDIR = exists_and_dir(config, 'THINCF_SERVER_TEMPLATEDIR', default=None)
 CLIENT_NAME_HEADER = config('THINCF_SERVER_CLIENT_NAME_HEADER', default=None)
 CLIENT_CERT_HEADER = config('THINCF_SERVER_CLIENT_CERT_HEADER', default=None)
+UPLOAD_CHUNK_SIZE = config('THINCF_SERVER_UPLOAD_CHUNK_SIZE', cast=int, default=64 * 1024)
+UPLOAD_MAX_INFLIGHT = config('THINCF_SERVER_UPLOAD_MAX_INFLIGHT', cast=int, default=1024 * 1024)
+UPLOAD_MAX_FILE_SIZE = config('THINCF_SERVER_UPLOAD_MAX_FILE_SIZE', cast=int, default=64 * 1024 * 1024)
+COMPILE_PROCESSES = config('THINCF_SERVER_COMPILE_PROCESSES', cast=int, default=0)
+EVALUATE_THREADS = config('THINCF_SERVER_EVALUATE_THREADS', cast=int, default=0)
+EVALUATE_PARALLEL_MIN = config('THINCF_SERVER_EVALUATE_PARALLEL_MIN', cast=int, default=64)
+EVALUATE_CACHE_SIZE = config('THINCF_SERVER_EVALUATE_CACHE_SIZE', cast=int, default=1024)
+EVALUATE_CACHE_AGE = config('THINCF_SERVER_EVALUATE_CACHE_AGE', cast=float, default=3600)
+EVALUATE_CACHE_MAX_BYTES = config('THINCF_SERVER_EVALUATE_CACHE_MAX_BYTES', cast=int, default=256 * 1024 * 1024)
+PRERENDER = config('THINCF_SERVER_PRERENDER', cast=bool, default=False)
+PRERENDER_CONCURRENCY = config('THINCF_SERVER_PRERENDER_CONCURRENCY', cast=int, default=4)
+SCRIPT_CACHE_SIZE = config('THINCF_SERVER_SCRIPT_CACHE_SIZE', cast=int, default=256)
+SCRIPT_CACHE_AGE = config('THINCF_SERVER_SCRIPT_CACHE_AGE', cast=float, default=3600)
+SCRIPT_CACHE_MAX_BYTES = config('THINCF_SERVER_SCRIPT_CACHE_MAX_BYTES', cast=int, default=256 * 1024)
+STATE_RETENTION = config('THINCF_SERVER_STATE_RETENTION', cast=int, default=10)
+STATE_POLL_INTERVAL = config('THINCF_SERVER_STATE_POLL_INTERVAL', cast=float, default=1)
+STREAM_CHUNK_SIZE = config('THINCF_SERVER_STREAM_CHUNK_SIZE', cast=int, default=64 * 1024)
 
 __all__ = (
     'STATEDIR',
     'TEMPLATEDIR',
     'CLIENT_NAME_HEADER',
     'CLIENT_CERT_HEADER',
+    'UPLOAD_CHUNK_SIZE',
+    'UPLOAD_MAX_INFLIGHT',
+    'UPLOAD_MAX_FILE_SIZE',
+    'COMPILE_PROCESSES',
+    'EVALUATE_THREADS',
+    'EVALUATE_PARALLEL_MIN',
+    'EVALUATE_CACHE_SIZE',
+    'EVALUATE_CACHE_AGE',
+    'EVALUATE_CACHE_MAX_BYTES',
+    'PRERENDER',
+    'PRERENDER_CONCURRENCY',
+    'SCRIPT_CACHE_SIZE',
+    'SCRIPT_CACHE_AGE',
+    'SCRIPT_CACHE_MAX_BYTES',
+    'STATE_RETENTION',
+    'STATE_POLL_INTERVAL',
+    'STREAM_CHUNK_SIZE',
 )
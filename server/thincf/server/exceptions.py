@@ -8,6 +8,10 @@ class Forbidden(HTTPException):
     def __init__(self, *detail) -> None:
         super().__init__(403, ''.join(*detail))
 
+class Conflict(HTTPException):
+    def __init__(self, *detail) -> None:
+        super().__init__(409, ''.join(*detail))
+
 class InternalServerError(HTTPException):
     def __init__(self, *detail) -> None:
         super().__init__(500, ''.join(*detail))
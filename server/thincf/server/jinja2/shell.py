@@ -1,8 +1,10 @@
+from hashlib import blake2b
 from itertools import count,product
 from jinja2 import nodes
 from jinja2.ext import Extension
 from shlex import quote as shquote
 
+from ..util import LRUCache
 from .base import StateExtension
 
 class ShellFunctionExtension(StateExtension):
@@ -63,24 +65,64 @@ class ShellEscapeExtension(Extension):
         super().__init__(environment)
         environment.filters['shquote'] = self._shquote
         environment.filters['octescape'] = self._octescape
+        self.heredoc_words = LRUCache(4096)
 
     def parse(self, parser):
         lineno = next(parser.stream).lineno
+        key = None
+        if not parser.stream.current.test('block_end'):
+            key = parser.parse_expression()
+
         body = parser.parse_statements(['name:endheredoc'], drop_needle=True)
-        return nodes.CallBlock(
-            self.call_method('_heredoc', [], lineno=lineno),
-            [], [], body, lineno=lineno
-        )
+
+        if key is None:
+            return nodes.CallBlock(
+                self.call_method('_heredoc', [], lineno=lineno),
+                [], [], body, lineno=lineno
+            )
+
+        # keyed here-documents are streamed rather than buffered; the body
+        # must end with a newline
+        return [
+            nodes.Output([
+                self.call_method('_heredoc_start', [key], lineno=lineno)
+            ], lineno=lineno),
+            *body,
+            nodes.Output([
+                self.call_method('_heredoc_end', [key], lineno=lineno)
+            ], lineno=lineno),
+        ]
 
     def _heredoc(self, caller):
         string = caller()
         if not string.endswith('\n'):
             string = string + '\n'
+        digest = blake2b(string.encode('utf8', 'surrogateescape')).digest()
+        if (word := self.heredoc_words.get(digest)) is None:
+            word = self.heredoc_words[digest] = self._heredoc_word(string)
+        return f"'{word}'\n{string}{word}\n"
+
+    # the delimiter is derived from a digest covering the body, e.g. the
+    # state identifier or a content digest, so the body can't contain it
+    # without containing its own digest
+    def _heredoc_key_word(self, key):
+        return 'EOF_' + blake2b(str(key).encode('utf8'), digest_size=12).hexdigest()
+
+    def _heredoc_start(self, key):
+        return f"'{self._heredoc_key_word(key)}'\n"
+
+    def _heredoc_end(self, key):
+        return f"{self._heredoc_key_word(key)}\n"
+
+    def _heredoc_word(self, string):
+        # the delimiter only ends the here-document if it appears on a
+        # line by itself, so any word not among the lines will do
+        lines = set(string.split('\n'))
         for i in count(1):
             for word in product(self.heredoc_chars, repeat=i):
                 word = ''.join(word)
-                if word not in string:
-                    return f"'{word}'\n{string}{word}\n"
+                if word not in lines:
+                    return word
 
     def _shquote(self, s):
         return shquote(str(s))
@@ -0,0 +1,186 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+# minimal metrics in the Prometheus text exposition format; updates are
+# cheap enough for the hot paths and safe to do from worker threads
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value)
+                .replace('\\', '\\\\')
+                .replace('"', '\\"')
+                .replace('\n', '\\n'),
+        )
+        for key,value in labels
+    ) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        with self.lock:
+            return [
+                (self.name, labels, value)
+                for labels,value in self.values.items()
+            ]
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for name,labels,value in self.samples():
+            yield f'{name}{format_labels(labels)} {format_value(value)}'
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, values):
+        with self.lock:
+            self.values = {
+                tuple(sorted(labels.items())): value
+                for labels,value in values
+            }
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    TIME_BUCKETS = (
+        .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+    )
+    SIZE_BUCKETS = tuple(2 ** exp for exp in range(8, 25, 2))
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if (state := self.values.get(key)) is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [
+                (labels, list(counts), total, count)
+                for labels,(counts,total,count) in self.values.items()
+            ]
+
+        samples = []
+        for labels,counts,total,count in values:
+            cumulative = 0
+            for bound,num in zip(self.buckets, counts):
+                cumulative += num
+                samples.append((
+                    f'{self.name}_bucket',
+                    labels + (('le', format_value(float(bound))),),
+                    cumulative,
+                ))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+REGISTRY = []
+
+# number of state files reported by EVALUATE_FILE_SECONDS_SLOWEST
+SLOWEST_FILES = 20
+
+def expose():
+    return ''.join(
+        f'{line}\n' for metric in REGISTRY for line in metric.expose()
+    )
+
+COMPILE_FILE_SECONDS = Histogram(
+    'thincf_compile_file_seconds',
+    'Time spent compiling a single state file.',
+)
+EVALUATE_SECONDS = Histogram(
+    'thincf_evaluate_seconds',
+    'Time spent evaluating a state for a host.',
+)
+EVALUATE_FILE_SECONDS = Histogram(
+    'thincf_evaluate_file_seconds',
+    'Time spent evaluating a single state file.',
+)
+EVALUATE_FILE_SECONDS_SLOWEST = Gauge(
+    'thincf_evaluate_file_seconds_slowest',
+    'Time spent evaluating the slowest files of the current state.',
+)
+RENDER_SECONDS = Histogram(
+    'thincf_render_seconds',
+    'Time spent rendering a script.',
+)
+UPLOAD_SECONDS = Histogram(
+    'thincf_upload_seconds',
+    'Time spent receiving, storing and compiling an uploaded state.',
+)
+UPLOAD_BYTES = Counter(
+    'thincf_upload_bytes_total',
+    'Bytes of state files received by uploads.',
+)
+RESPONSE_BYTES = Histogram(
+    'thincf_response_bytes',
+    'Size of script responses as sent.',
+    Histogram.SIZE_BUCKETS,
+)
+STATE_INFO = Gauge(
+    'thincf_state_info',
+    'Identifier of the state being served.',
+)
+CACHE_HITS = Gauge(
+    'thincf_cache_hits',
+    'Hits of the server\'s caches since they were created.',
+)
+CACHE_MISSES = Gauge(
+    'thincf_cache_misses',
+    'Misses of the server\'s caches since they were created.',
+)
+CACHE_ENTRIES = Gauge(
+    'thincf_cache_entries',
+    'Number of entries in the server\'s caches.',
+)
+CACHE_BYTES = Gauge(
+    'thincf_cache_bytes',
+    'Size of the entries in the server\'s caches that are bounded by size.',
+)
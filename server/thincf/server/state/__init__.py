@@ -1,20 +1,49 @@
+from asyncio import gather,get_running_loop
+from concurrent.futures import Future,ProcessPoolExecutor
+from functools import lru_cache
 from hashlib import blake2b
-from jinja2 import Environment,FunctionLoader
+from itertools import repeat
+from jinja2 import BaseLoader,Environment,TemplateNotFound
+from logging import getLogger
 from pathlib import Path
 from re import compile as regex
+from threading import Lock
+from time import perf_counter
 from types import SimpleNamespace
 
-from ..util import update_hash
+from .. import config,metrics
+from ..util import LRUCache,multidict_key,update_hash
 from ..jinja2 import *
 from .action import *
 from .dirs import Directories
 from .files import *
 from .hosts import Hosts
 
+log = getLogger(__name__)
+
+class StateLoader(BaseLoader):
+    def __init__(self, state):
+        self.state = state
+
+    def get_source(self, environment, template):
+        if (content := self.state.files.get(Path(template))) is None:
+            raise TemplateNotFound(template)
+        return (content, template, lambda: True)
+
+    def load(self, environment, name, globals=None):
+        if (code := self.state.code.get(Path(name))) is None:
+            return super().load(environment, name, globals)
+
+        return environment.template_class.from_code(
+            environment, code, environment.make_globals(globals),
+            lambda: True,
+        )
+
 class StateEnvironment(Environment):
-    def __init__(self, loader_function):
+    def __init__(self, loader=None, bytecode_cache=None):
         super().__init__(
-            loader = FunctionLoader(loader_function),
+            loader = loader,
+            bytecode_cache = bytecode_cache,
             extensions = (
                 "jinja2.ext.do",
                 StateMetadataExtension,
@@ -32,30 +61,100 @@ class StateEnvironment(Environment):
             )
         return template
 
+@lru_cache(maxsize=None)
+def compiler_environment():
+    return StateEnvironment()
+
+def compile_template(source, name, to_code=True):
+    # runs in a worker thread or process; the latter returns the generated
+    # python source since code objects can't be passed between processes
+    start = perf_counter()
+    source = compiler_environment().compile(source, name, name, raw=True)
+    if to_code:
+        source = compile(source, name, 'exec')
+    return source,perf_counter() - start
+
+def compile_python(source, name):
+    start = perf_counter()
+    code = compile(source, name, 'exec')
+    return code,perf_counter() - start
+
+# evaluations hold the rendered contents of every file, both as text and
+# as they are sent to the client
+def result_size(result):
+    return sum(
+        len(entry.content) + len(entry.data)
+        for entry in result['entries'] if entry.type == 'file'
+    )
+
 class State:
     person_client = b'thincf.cl.state'
 
-    def __init__(self, identifier, hosts, dirs, files, actions):
+    def __init__(self, identifier, hosts, dirs, files, actions,
+                 bytecode_cache=None, digests=None):
         self.identifier = identifier
         self.hosts = hosts
         self.dirs = dirs
         self.files = files
         self.actions = actions
-        self.jinja_files = StateEnvironment(self.load_template)
+        self.digests = {} if digests is None else digests
+        self.code = {}
+        self.evaluate_times = {}
+        self.jinja_files = StateEnvironment(
+            StateLoader(self), bytecode_cache,
+        )
+        self.cache = LRUCache(
+            config.EVALUATE_CACHE_SIZE,
+            config.EVALUATE_CACHE_AGE,
+            config.EVALUATE_CACHE_MAX_BYTES,
+            result_size,
+        )
+        self.pending = {}
+        self.lock = Lock()
 
     @classmethod
-    async def from_iterator(cls, identifier, iterator):
+    async def from_iterator(cls, identifier, iterator, executor=None,
+                            bytecode_cache=None, base=None):
         hosts = None
         dirs = None
         files = {}
         actions = {}
-
-        async for filename,content in iterator:
-            if str(filename) == 'hosts.ini':
-                hosts = Hosts.from_str(filename.name, content)
+        digests = {}
+        code = {}
+        loop = get_running_loop()
+
+        async for filename,content,digest in iterator:
+            digests[filename] = digest
+
+            # files left out of a delta upload come without content;
+            # whatever the base state made of them can be reused as is
+            if content is None:
+                if base is None or base.digests.get(filename) != digest:
+                    raise Exception(f"{filename} missing")
+
+                if str(filename) == 'hosts.ini':
+                    hosts = base.hosts
+
+                elif str(filename) == 'dirs.ini':
+                    dirs = base.dirs
+
+                else:
+                    files[filename] = await loop.run_in_executor(
+                        None, base.files.__getitem__, filename
+                    )
+                    if filename in base.code:
+                        code[filename] = base.code[filename]
+
+            # parsing large configs would otherwise block the event loop
+            elif str(filename) == 'hosts.ini':
+                hosts = await loop.run_in_executor(
+                    None, Hosts.from_str, filename.name, content
+                )
 
             elif str(filename) == 'dirs.ini':
-                dirs = Directories.from_str(filename.name, content)
+                dirs = await loop.run_in_executor(
+                    None, Directories.from_str, filename.name, content
+                )
 
             else:
                 files[filename] = content
@@ -66,16 +165,68 @@ class State:
         if dirs is None:
             dirs = Directories()
 
-        return cls(identifier, hosts, dirs, files, actions)
+        state = cls(
+            identifier, hosts, dirs, files, actions, bytecode_cache, digests,
+        )
+        state.code.update(code)
+        await state.compile(executor)
+        return state
+
+    async def compile(self, executor=None):
+        loop = get_running_loop()
+        bcc = self.jinja_files.bytecode_cache
+
+        async def compile_file(path):
+            name = str(path)
+            source = self.files[path]
+
+            if bcc is not None:
+                bucket = await loop.run_in_executor(
+                    None, bcc.get_bucket, self.jinja_files, name, name, source
+                )
+                if bucket.code is not None:
+                    log.debug(f"Loaded '{path}' from bytecode cache")
+                    self.code[path] = bucket.code
+                    return
+
+            # code taken over from a base state only needs to be put
+            # into this state's bytecode cache
+            if path not in self.code:
+                threaded = not isinstance(executor, ProcessPoolExecutor)
+                code,duration = await loop.run_in_executor(
+                    executor, compile_template, source, name, threaded
+                )
+                if not threaded:
+                    code,seconds = await loop.run_in_executor(
+                        None, compile_python, code, name
+                    )
+                    duration += seconds
+
+                self.code[path] = code
+                metrics.COMPILE_FILE_SECONDS.observe(duration)
+                log.debug(f"Compiled '{path}' in {duration * 1000:.1f}ms")
+
+            if bcc is not None:
+                bucket.code = self.code[path]
+                await loop.run_in_executor(None, bcc.set_bucket, bucket)
+
+        await gather(*(compile_file(path) for path in self.files.keys()))
 
     def find_host(self, client_name):
         return self.hosts.get(client_name)
 
-    def load_template(self, name):
-        if (content := self.files.get(Path(name))) is not None:
-            return (content, name, lambda: True)
-
     def evaluate_file(self, path, host, env):
+        start = perf_counter()
+        try:
+            return self.render_file(path, host, env)
+        finally:
+            duration = perf_counter() - start
+            metrics.EVALUATE_FILE_SECONDS.observe(duration)
+            with self.lock:
+                self.evaluate_times[path] = \
+                    self.evaluate_times.get(path, 0) + duration
+
+    def render_file(self, path, host, env):
         template = self.jinja_files.get_template(str(path))
         metadata = SimpleNamespace(
             type = None,
@@ -111,14 +262,57 @@ class State:
     def evaluate_dir(self, path):
         return DirEntry(path, **self.dirs.evaluate(path))
 
-    def evaluate(self, host, states, env):
+    def evaluate(self, host, env, executor=None):
+        # the result only depends on host and environment, so it can be
+        # reused until this state gets replaced
+        key = (self.identifier, host.digest, multidict_key(env))
+
+        if (result := self.cache.get(key)) is not None:
+            return result
+
+        # threads asking for an evaluation already under way wait for it
+        # instead of doing the same work again
+        with self.lock:
+            if leader := (future := self.pending.get(key)) is None:
+                future = self.pending[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            with metrics.EVALUATE_SECONDS.time():
+                result = self.evaluate_host(host, env, executor)
+            self.cache[key] = result
+            future.set_result(result)
+            return result
+
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    def evaluate_host(self, host, env, executor=None):
         entries = {}
         actions = {}
 
-        # walk all files and evaluate them
-        for path,item in self.files.items():
-            entry = self.evaluate_file(path, host, env)
+        # walk all files and evaluate them; large states get spread
+        # across the executor, which hands back results in file order
+        paths = list(self.files.keys())
+
+        if executor is not None and len(paths) >= config.EVALUATE_PARALLEL_MIN:
+            evaluated = executor.map(
+                self.evaluate_file, paths,
+                repeat(host), repeat(env),
+            )
+        else:
+            evaluated = (
+                self.evaluate_file(path, host, env) for path in paths
+            )
 
+        for path,entry in zip(paths, evaluated):
             if entry is None:
                 continue
 
@@ -167,22 +361,18 @@ class State:
             for name,action_index in mkidx(i.name for i in invocations)
         }
 
-        # create identifier hash
+        # create identifier hash from the digests of all entries and
+        # actions; file contents only get hashed once for their sha256,
+        # which the script and blob requests reuse along with the result
         h = blake2b(digest_size=20, person=self.person_client)
         update_hash(h, self.identifier)
-
-        for entry in entries:
-            entry.add_to_hash(h)
-
-        for entry in actions.values():
-            entry.action.add_to_hash(h)
-
-        if (identifier := h.hexdigest()) not in states:
-            return dict(
-                identifier = identifier,
-                entries = entries,
-                actions = actions,
-            )
-
-        else:
-            return None
+        update_hash(h, *sorted(entry.identity for entry in entries))
+        update_hash(h, *sorted(
+            entry.action.identity for entry in actions.values()
+        ))
+
+        return dict(
+            identifier = h.hexdigest(),
+            entries = entries,
+            actions = actions,
+        )
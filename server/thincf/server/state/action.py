@@ -1,15 +1,25 @@
 from dataclasses import dataclass,field
+from functools import cached_property
+from hashlib import blake2b
 from typing import Tuple
 from ..util import update_hash
 
 @dataclass
 class Action:
+    person = b'thincf.action'
+
     name: str
     content: str = field(repr=False)
 
     def add_to_hash(self, h):
         update_hash(h, self.name, self.content)
 
+    @cached_property
+    def identity(self):
+        h = blake2b(digest_size=20, person=self.person)
+        self.add_to_hash(h)
+        return h.hexdigest()
+
 @dataclass(frozen=True)
 class Invocation:
     name: str
@@ -40,6 +40,7 @@ class Directory:
 
         self.path = pattern
         self.pattern = regex(fr'{pat}{regex_escape(pattern[idx:])}$')
+        self.prefix = pattern.partition('/')[0]
         self.order = ord
         self.config = config
 
@@ -49,6 +50,10 @@ class Directory:
     def matches_path(self, path):
         return bool(self.pattern.match(str(path)))
 
+    @property
+    def has_prefix(self):
+        return not self.PATTERN.search(self.prefix)
+
     @property
     def has_pattern(self):
         return self.order != (0, 0, 0, 0)
@@ -86,6 +91,11 @@ class Directories(list):
         'create_if': Config(),
     }
 
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.candidates = {}
+        self.evaluated = {}
+
     @classmethod
     def from_str(cls, name, data):
         return cls(
@@ -101,14 +111,32 @@ class Directories(list):
             )
         )
 
+    def candidates_for(self, path):
+        # a directory whose first path component is free of patterns
+        # can only ever match paths starting with that component; keep
+        # the candidates in list order to retain the merge precedence
+        first = str(path).partition('/')[0]
+
+        if (candidates := self.candidates.get(first)) is None:
+            candidates = self.candidates[first] = [
+                item for item in self
+                if not item.has_prefix or item.prefix == first
+            ]
+
+        return candidates
+
     def evaluate(self, path):
+        if (config := self.evaluated.get(path)) is not None:
+            return config
+
         config = {}
 
-        for item in self:
+        for item in self.candidates_for(path):
             if item.matches_path(path):
                 config.update({
                     key: self.config[key].get(item.config, key)
                     for key in item.config.keys()
                 })
 
+        self.evaluated[path] = config
         return config
@@ -1,7 +1,11 @@
 from abc import ABC,abstractmethod
+from functools import cached_property
+from hashlib import blake2b,sha256
 from ..util import update_hash
 
 class Entry(ABC):
+    person = b'thincf.entry'
+
     def __init__(self, path, content, user=0, group=0, mode=None,
                  actions=None):
         self.path = path
@@ -20,6 +24,14 @@ class Entry(ABC):
     def add_to_hash(self, h):
         pass
 
+    # identifies everything a client gets to see of this entry
+    @cached_property
+    def identity(self):
+        h = blake2b(digest_size=20, person=self.person)
+        update_hash(h, self.type)
+        self.add_to_hash(h)
+        return h.hexdigest()
+
 class FileEntry(Entry):
     default_mode = 0o0644
 
@@ -27,6 +39,19 @@ class FileEntry(Entry):
     def type(self):
         return 'file'
 
+    # the file as written by a client; here-documents always end in a
+    # newline
+    @cached_property
+    def data(self):
+        content = self.content
+        if not content.endswith('\n'):
+            content = content + '\n'
+        return content.encode('utf8', 'surrogateescape')
+
+    @cached_property
+    def digest(self):
+        return sha256(self.data).hexdigest()
+
     def add_to_hash(self, h):
         update_hash(
             h,
@@ -34,7 +59,7 @@ class FileEntry(Entry):
                 self.user,
                 self.group,
                 self.mode,
-                self.content ]
+                self.digest ]
             + list(self.actions)
         )
 
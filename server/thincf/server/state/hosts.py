@@ -1,10 +1,16 @@
+from bisect import bisect_left
 from collections import namedtuple
+from functools import cached_property,lru_cache
+from hashlib import blake2b
+from itertools import islice
 from re import compile as regex, escape as regex_escape
-from ..util import read_ini
+from ..util import read_ini,update_hash
 
 FindKey = namedtuple('FindKey', ('value', 'wildcard'))
 
 class Host:
+    person = b'thincf.host'
+
     PATTERNS = (
         (r'\*', r'.+'),
     )
@@ -16,6 +22,25 @@ class Host:
         self.name = name
         self.config = config
 
+    @cached_property
+    def items(self):
+        return list(self.config.multi_items())
+
+    # identifies everything a template gets to see of this host
+    @cached_property
+    def digest(self):
+        h = blake2b(digest_size=20, person=self.person)
+        update_hash(h, self.name)
+        for key,value in self.items:
+            update_hash(h, key, value)
+        return h.hexdigest()
+
+    @cached_property
+    def index(self):
+        return sorted(
+            (key, pos) for pos,(key,_) in enumerate(self.items)
+        )
+
     def __contains__(self, pattern):
         try:
             next(self.find(pattern, only_values=True))
@@ -29,16 +54,46 @@ class Host:
         except StopIteration:
             raise KeyError(pattern)
 
-    def find(self, pattern, only_values=False):
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def compile(cls, pattern):
         pat = r'^'
         idx = 0
-        for match in self.PATTERN.finditer(pattern):
-            _,repl = self.PATTERNS[match.lastindex-1]
+        for match in cls.PATTERN.finditer(pattern):
+            _,repl = cls.PATTERNS[match.lastindex-1]
             pat += fr'{regex_escape(pattern[idx:match.start()])}({repl})'
             idx = match.end()
-        pat = regex(fr'{pat}{regex_escape(pattern[idx:])}$')
+        return regex(fr'{pat}{regex_escape(pattern[idx:])}$')
+
+    def candidates(self, pattern):
+        # only keys sharing the literal prefix of pattern can match; look
+        # them up in the sorted index and return them in config order
+        if (match := self.PATTERN.search(pattern)) is None:
+            prefix = pattern
+        else:
+            prefix = pattern[:match.start()]
+
+        positions = []
+        for key,pos in islice(self.index, bisect_left(self.index, (prefix,)), None):
+            if not key.startswith(prefix):
+                break
+            positions.append(pos)
+
+        return ( self.items[pos] for pos in sorted(positions) )
+
+    def find(self, pattern, only_values=False):
+        # exact keys don't need a regex at all
+        if self.PATTERN.search(pattern) is None:
+            for value in self.config.getlist(pattern):
+                if only_values:
+                    yield value
+                else:
+                    yield ( FindKey(pattern, None), value )
+            return
+
+        pat = self.compile(pattern)
 
-        for key,value in self.config.multi_items():
+        for key,value in self.candidates(pattern):
             if (m := pat.match(key)) is None:
                 continue
 
@@ -0,0 +1,233 @@
+from collections.abc import Mapping
+from fcntl import LOCK_EX,LOCK_SH,LOCK_UN,flock
+from hashlib import sha256
+from os import chmod,getpid,readlink,symlink
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkstemp
+from threading import get_ident
+from time import time
+
+from .util import link_or_copy,read_manifest
+
+# content addressed storage of states: every file is kept once as a blob
+# named by its sha256 and a state is nothing but a manifest mapping its
+# paths to those blobs
+#
+#   STATEDIR/.blobs/<2 hex digits>/<digest>
+#   STATEDIR/.states/<identifier>
+#   STATEDIR/.states/.current -> <identifier>
+#   STATEDIR/.states/.last-good -> <identifier>
+#   STATEDIR/.states/.lock
+#
+# the pointers are symlinks replaced atomically; .current names the
+# state to be served, .last-good the last one known to load
+#
+# state directories of earlier versions are still picked up and count
+# against the retention like any other state
+#
+# the store may be shared by several worker processes: uploads hold a
+# shared lock on .lock from storing their first blob until their
+# manifest is written, the garbage collector an exclusive one
+class BlobStore:
+    CURRENT = '.current'
+    LAST_GOOD = '.last-good'
+    # temporary files older than this are left over by dead workers
+    STALE_AGE = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.blobs = path / '.blobs'
+        self.states = path / '.states'
+        self.lockfile = self.states / '.lock'
+
+    def setup(self):
+        self.blobs.mkdir(exist_ok=True)
+        self.states.mkdir(exist_ok=True)
+        self.lockfile.touch()
+
+    def blob_path(self, digest):
+        return self.blobs / digest[:2] / digest
+
+    def read_blob(self, digest):
+        return self.blob_path(digest).read_bytes()
+
+    # reads a batch of files in one go; meant to be run in a thread
+    def read_files(self, manifest):
+        return [
+            (path, self.read_blob(digest).decode('utf8'), digest)
+            for path,digest in manifest
+        ]
+
+    # blocks while the garbage collector runs, so better call it from
+    # a thread
+    def transaction(self):
+        return StoreLock(self.lockfile, LOCK_SH)
+
+    def writer(self):
+        return BlobWriter(self)
+
+    def add(self, filename, digest):
+        path = self.blob_path(digest)
+
+        if path.exists():
+            filename.unlink()
+        else:
+            path.parent.mkdir(exist_ok=True)
+            chmod(filename, 0o444)
+            filename.rename(path)
+
+        return digest
+
+    def hold(self, digest):
+        if not self.blob_path(digest).exists():
+            raise Exception(f"Blob {digest} missing")
+
+    def import_file(self, filename, digest):
+        if not (path := self.blob_path(digest)).exists():
+            path.parent.mkdir(exist_ok=True)
+            link_or_copy(filename, path)
+
+    def identifiers(self):
+        return sorted(
+            item.name for item in self.states.iterdir()
+            if not item.name.startswith('.')
+        )
+
+    def legacy_identifiers(self):
+        return sorted(
+            item.name for item in self.path.iterdir()
+            if not item.name.startswith('.') and item.is_dir()
+        )
+
+    def read_pointer(self, name):
+        try:
+            return readlink(self.states / name)
+        except FileNotFoundError:
+            return None
+
+    def write_pointer(self, name, identifier):
+        tmp = self.states / f'{name}.{getpid()}.{get_ident()}'
+        tmp.unlink(missing_ok=True)
+        symlink(identifier, tmp)
+        tmp.rename(self.states / name)
+
+    def read_manifest(self, identifier):
+        return read_manifest((self.states / identifier).read_text('utf8'))
+
+    def write_manifest(self, identifier, digests):
+        fd,name = mkstemp(dir=self.states, prefix='.')
+        with open(fd, 'w', encoding='utf8') as fp:
+            for path,digest in sorted(digests.items()):
+                fp.write(f'{digest}  {path}\n')
+        Path(name).rename(self.states / identifier)
+
+    # drops every state but the newest ones (all of them for a retention
+    # of 0), those pointed to and those named in keep, then every blob
+    # no remaining state refers to; returns the identifiers of the
+    # dropped states
+    def collect(self, retention, keep=()):
+        with StoreLock(self.lockfile, LOCK_EX):
+            identifiers = self.identifiers()
+            legacy = self.legacy_identifiers()
+            newest = sorted(set(identifiers) | set(legacy))
+            keep = set(keep)
+            keep.update(newest[-retention:] if retention > 0 else newest)
+            keep.update(
+                identifier for name in (self.CURRENT, self.LAST_GOOD)
+                if (identifier := self.read_pointer(name)) is not None
+            )
+
+            live = set()
+            for identifier in identifiers:
+                if identifier in keep:
+                    live.update(self.read_manifest(identifier).values())
+
+            dropped = []
+
+            for identifier in identifiers:
+                if identifier not in keep:
+                    (self.states / identifier).unlink(missing_ok=True)
+                    dropped.append(identifier)
+
+            # imported legacy directories aren't needed anymore either
+            for identifier in legacy:
+                if identifier not in keep or identifier in identifiers:
+                    rmtree(self.path / identifier, ignore_errors=True)
+                    if identifier not in keep and identifier not in dropped:
+                        dropped.append(identifier)
+
+            for sub in self.blobs.iterdir():
+                if not sub.is_dir():
+                    continue
+                for blob in sub.iterdir():
+                    if blob.name not in live:
+                        blob.unlink(missing_ok=True)
+
+            self.collect_stale()
+            return dropped
+
+    # temporary blobs, manifests and pointers of uploads that never
+    # finished; meant to be called with the exclusive lock held
+    def collect_stale(self):
+        keep = { self.CURRENT, self.LAST_GOOD, self.lockfile.name }
+        cutoff = time() - self.STALE_AGE
+
+        for path in (self.blobs, self.states):
+            for item in path.iterdir():
+                if not item.name.startswith('.') or item.name in keep:
+                    continue
+                try:
+                    if item.lstat().st_mtime < cutoff:
+                        item.unlink()
+                except FileNotFoundError:
+                    pass
+
+class StoreLock:
+    def __init__(self, path, operation):
+        self.fp = open(path, 'rb')
+        flock(self.fp, operation)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        flock(self.fp, LOCK_UN)
+        self.fp.close()
+
+class BlobWriter:
+    def __init__(self, store):
+        fd,name = mkstemp(dir=store.blobs, prefix='.')
+        self.store = store
+        self.filename = Path(name)
+        self.fp = open(fd, 'wb')
+        self.hash = sha256()
+
+    def write(self, chunk):
+        self.fp.write(chunk)
+        self.hash.update(chunk)
+
+    def commit(self):
+        self.fp.close()
+        return self.store.add(self.filename, self.hash.hexdigest())
+
+    def abort(self):
+        self.fp.close()
+        self.filename.unlink(missing_ok=True)
+
+# template sources of a state that has been compiled are hardly ever
+# needed again; rather than keeping them around in every worker they
+# are read from the store on access
+class BlobSources(Mapping):
+    def __init__(self, store, digests):
+        self.store = store
+        self.digests = digests
+
+    def __getitem__(self, path):
+        return self.store.read_blob(self.digests[path]).decode('utf8')
+
+    def __iter__(self):
+        return iter(self.digests)
+
+    def __len__(self):
+        return len(self.digests)
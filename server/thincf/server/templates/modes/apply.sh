@@ -7,7 +7,7 @@
 
 ## automatic fetch enable?
 % if args.fetch
-%   do install_csp()
+%   include "csp"
 % endif
 
 ## load latest and see if there such a state
@@ -224,7 +224,7 @@ apply_change () {
         case "${csp_type}" in
             file)
                 print_content_diff
-                ${csp} cat ${octfile} | write_contents "${file}"
+                ${csp} cat ${csp_content} | write_contents "${file}"
                 ;;
             dir)
                 create_directory "${file}"
@@ -262,7 +262,7 @@ apply_change () {
         if content_changed; then
             before_change
             print_content_diff
-            ${csp} cat ${octfile} | write_contents "${file}"
+            ${csp} cat ${csp_content} | write_contents "${file}"
         fi
     fi
 
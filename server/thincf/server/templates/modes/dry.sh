@@ -3,7 +3,7 @@
 
 ## automatic fetch enable?
 % if args.fetch
-%   do install_csp()
+%   include "csp"
 % endif
 
 ## load latest and see if there such a state
@@ -1,6 +1,5 @@
-% set csp = install_csp()
-% if csp
-% do csp
+% if state
+% include "csp"
 printf 'Successfully fetched new state\n'
 % else
 printf 'No new state available\n'
@@ -1,22 +1,34 @@
 from asyncio import (
+    Event as AsyncEvent,
     Queue as AsyncQueue,
     create_task,
     get_running_loop,
+    run_coroutine_threadsafe,
     wait as async_wait,
-    FIRST_COMPLETED,
 )
+from collections import OrderedDict,deque
 from configparser import (
     ConfigParser,
     Interpolation,
     InterpolationMissingOptionError,
 )
 from functools import wraps
-from io import RawIOBase
+from hashlib import blake2b
+from io import BytesIO,RawIOBase
+from os import link
 from pathlib import Path
-from queue import Queue
 from re import compile as regex
+from shutil import copy2
 from starlette.datastructures import ImmutableMultiDict
-from tarfile import TarFile
+from tarfile import TarFile,TarInfo
+from threading import Condition,Event,Lock
+from time import monotonic,perf_counter
+from zlib import DEFLATED,compressobj as zlib_compressobj
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from . import config
 from .exceptions import BadRequest,Forbidden
@@ -27,6 +39,35 @@ def resolve_relative(*path):
     except ValueError:
         pass
 
+# reads a list of file digests as written by sha256sum(1) or FreeBSD's
+# sha256 -r; maps the relative path to the hex digest
+def read_manifest(text):
+    manifest = {}
+
+    for line in text.splitlines():
+        if not line:
+            continue
+
+        digest,_,name = line.partition(' ')
+        if name[:1] in (' ', '*'):
+            name = name[1:]
+
+        if len(digest) != 64 or (path := resolve_relative(name)) is None:
+            raise ValueError(f"Invalid manifest line '{line}'")
+
+        int(digest, 16)
+        manifest[path] = digest.lower()
+
+    return manifest
+
+# hardlinks a file into another state directory, falling back to a copy
+# where that's not possible (e.g. crossing filesystems)
+def link_or_copy(src, dst):
+    try:
+        link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
 def requires_client_name(method):
     @wraps(method)
     async def _impl(self, request, *args, **kwargs):
@@ -40,94 +81,433 @@ def requires_client_name(method):
         return await method(self, request, *args, client_name, **kwargs)
     return _impl
 
-def isplit(sliceable, index):
-    return sliceable[:index],sliceable[index:]
-
-def memcpy(dest, src):
-    l = len(src)
-    dest[:l] = src
-    return l
-
+# hands chunks from the event loop to a thread reading them like a file;
+# large chunks are queued as they are, small ones get coalesced in a ring
+# buffer so the reader is served large contiguous reads. Chunks must not be
+# modified once written.
 class ChunkReader(RawIOBase):
-    def __init__(self, get_next_chunk):
-        self.get_next_chunk = get_next_chunk
-        self.cur = None
+    def __init__(self, capacity, threshold=16 * 1024):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.threshold = threshold
+        # queued [view, ring offset or None] in order, ring usage and the
+        # total number of bytes queued
+        self.segments = deque()
+        self.start = 0
+        self.used = 0
+        self.size = 0
+        self.eof = False
+        self.cond = Condition()
+        self.waiter = None
 
     def readable(self):
         return True
 
     def readinto(self, buf):
-        # if we don't have data left ask for a chunk
-        if not self.cur:
-            if not (cur := self.get_next_chunk()):
-                return 0
+        with self.cond:
+            while not self.size and not self.eof:
+                self.cond.wait()
+
+            total = 0
+            capacity = len(self.buf)
+            while self.segments and total < len(buf):
+                segment = self.segments[0]
+                view, offset = segment
+                length = min(len(buf) - total, len(view))
+                buf[total:total + length] = view[:length]
+                total += length
+                self.size -= length
+
+                if offset is not None:
+                    self.start = (self.start + length) % capacity
+                    self.used -= length
+                    segment[1] = offset + length
+
+                if length == len(view):
+                    self.segments.popleft()
+                else:
+                    segment[0] = view[length:]
+
+            # wake up the writer once there is room for more than a chunk
+            if self.size <= capacity // 2 and (waiter := self.waiter) is not None:
+                self.waiter = None
+                waiter.get_loop().call_soon_threadsafe(
+                    lambda: waiter.done() or waiter.set_result(None)
+                )
 
-            self.cur = memoryview(cur)
+            return total
+
+    async def write(self, chunk):
+        chunk = memoryview(chunk).cast('B')
+        capacity = len(self.buf)
+
+        while chunk:
+            with self.cond:
+                if self.size >= capacity:
+                    self.waiter = get_running_loop().create_future()
+                    waiter = self.waiter
+
+                elif len(chunk) >= self.threshold:
+                    self.segments.append([chunk, None])
+                    self.size += len(chunk)
+                    self.cond.notify()
+                    break
+
+                else:
+                    # copy as much as fits, wrapping around the end, and
+                    # merge with the previous segment if it ends right here
+                    pos = (self.start + self.used) % capacity
+                    length = min(len(chunk), capacity - self.size,
+                                 capacity - pos)
+                    self.view[pos:pos + length] = chunk[:length]
+                    self.used += length
+                    self.size += length
+                    chunk = chunk[length:]
+
+                    last = self.segments[-1] if self.segments else None
+                    if last is not None and last[1] is not None \
+                            and last[1] + len(last[0]) == pos:
+                        last[0] = self.view[last[1]:pos + length]
+                    else:
+                        self.segments.append([self.view[pos:pos + length], pos])
+
+                    self.cond.notify()
+                    continue
 
-        # slice off size of buf from front of cur
-        front,self.cur = isplit(self.cur, len(buf))
+            await waiter
 
-        # copy front into buf
-        return memcpy(buf, front)
+    def finish(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify()
 
-async def tariter(bytestream, executor=None, compression='*'):
+async def tariter(bytestream, executor=None, compression='*',
+                  chunk_size=64 * 1024, max_inflight=1024 * 1024,
+                  max_file_size=None):
     loop = get_running_loop()
-    bq = Queue()
-    rq = AsyncQueue()
+    reader = ChunkReader(max_inflight)
+    stop = Event()
+    rq = AsyncQueue(max(1, max_inflight // chunk_size))
 
-    def extract():
-        loop.call_soon_threadsafe(rq.put_nowait, True)
-        tar = TarFile.open(
-            fileobj=ChunkReader(bq.get),
-            mode=f'r|{compression}'
-        )
-        while tarinfo := tar.next():
-            if tarinfo.isfile():
-                data = tar.extractfile(tarinfo).read()
-            else:
-                data = None
-            loop.call_soon_threadsafe(rq.put_nowait, (tarinfo, data))
+    def put(*item):
+        # blocks while the consumer is behind
+        run_coroutine_threadsafe(rq.put(item), loop).result()
 
-    # schedule extract to be run in thread and wait for start signal
+    def extract():
+        try:
+            tar = TarFile.open(
+                fileobj=reader,
+                mode=f'r|{compression}',
+                bufsize=chunk_size,
+            )
+            while (tarinfo := tar.next()) and not stop.is_set():
+                if max_file_size is not None and tarinfo.size > max_file_size:
+                    raise BadRequest(
+                        f"File '{tarinfo.name}' exceeds {max_file_size} bytes."
+                    )
+
+                put('member', tarinfo)
+
+                if tarinfo.isfile():
+                    data = tar.extractfile(tarinfo)
+                    while (chunk := data.read(chunk_size)) and not stop.is_set():
+                        put('data', chunk)
+
+                put('end', None)
+        finally:
+            put('done', None)
+
+    async def feed():
+        # copy data into the reader's buffer, waiting for the thread
+        # whenever it is full; closing it signals the end of data
+        try:
+            async for chunk in bytestream:
+                await reader.write(chunk)
+        finally:
+            reader.finish()
+
+    async def member_data():
+        while (item := await rq.get())[0] == 'data':
+            yield item[1]
+
+        # thread ended in the middle of this member
+        if item[0] == 'done':
+            rq.put_nowait(item)
+
+    # schedule extract to be run in thread and feed it from a task
     extract = loop.run_in_executor(executor, extract)
-    if not await rq.get():
+    feeder = create_task(feed())
+
+    try:
+        while True:
+            kind,item = await rq.get()
+
+            # data of a member the consumer didn't read completely
+            if kind in ('data', 'end'):
+                continue
+
+            if kind == 'done':
+                break
+
+            yield item,member_data()
+
+        # whatever follows the end of the archive is of no interest
+        await extract
+
+    finally:
+        # let the thread run into its stop condition in case it's blocked
+        # on either of the queues
+        stop.set()
+        feeder.cancel()
+        reader.finish()
+        while not extract.done():
+            while not rq.empty():
+                rq.get_nowait()
+            await async_wait([extract], timeout=0.1)
+
+# builds an uncompressed tar archive of (name, bytes) pairs; meant to be
+# run in a thread
+def make_tar(files):
+    buf = BytesIO()
+    with TarFile.open(fileobj=buf, mode='w') as tar:
+        for name,data in files:
+            info = TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o444
+            tar.addfile(info, BytesIO(data))
+    return buf.getvalue()
+
+def multidict_key(multidict):
+    return tuple(sorted(multidict.multi_items()))
+
+COMPRESSORS = {
+    'gzip': lambda: zlib_compressobj(6, DEFLATED, 31),
+}
+
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda: zstandard.ZstdCompressor().compressobj()
+
+def negotiate_encoding(accept_encoding):
+    accepted = {}
+
+    for part in accept_encoding.split(','):
+        coding,_,params = part.strip().partition(';')
+        qvalue = 1.0
+        for param in params.split(';'):
+            name,_,value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        accepted[coding.strip().lower()] = qvalue
+
+    for coding in ('zstd', 'gzip'):
+        if coding in COMPRESSORS and accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+
+def compress(data, encoding):
+    if encoding is None:
+        return data
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+def compress_chunks(chunks, encoding):
+    if encoding is None:
+        for chunk in chunks:
+            yield chunk,chunk
         return
 
-    # send chunks of data to the thread
-    async for chunk in bytestream:
-        bq.put(chunk)
-
-        # end of data
-        if not chunk:
-            # build awaitable set consisting of extract thread
-            aws = set([extract])
-
-            # as long as we have something to wait for...
-            while aws:
-                # if that something is just the thread future, add task
-                # to also wait for result
-                if not aws.difference([extract]):
-                    aws.add(create_task(rq.get()))
-
-                # wait for at least one future to complete and resolve
-                done,aws = await async_wait(
-                    aws, return_when=FIRST_COMPLETED
-                )
-                for fut in done:
-                    # either the thread is complete
-                    if fut is extract:
-                        fut.result()
-                    # or it's just a result from the queue
-                    else:
-                        yield fut.result()
+    compressor = COMPRESSORS[encoding]()
+    for chunk in chunks:
+        yield chunk,compressor.compress(chunk)
+    yield b'',compressor.flush()
+
+def encode_chunks(iterable, size, encoding='utf8'):
+    parts = []
+    length = 0
+
+    for part in iterable:
+        parts.append(part)
+        length += len(part)
 
-        # drain result queue without waiting
-        while not rq.empty():
-            yield rq.get_nowait()
+        if length >= size:
+            # large parts, like file contents, are encoded piecewise
+            data = ''.join(parts)
+            for start in range(0, len(data), size):
+                yield data[start:start + size].encode(encoding)
+            parts.clear()
+            length = 0
 
-        # (premature) end of thread?
-        if extract.done():
-            break
+    if parts:
+        yield ''.join(parts).encode(encoding)
+
+# reports the time spent producing the items, not counting the time the
+# consumer takes in between, once the iterable is exhausted
+def time_iterator(iterable, observe):
+    elapsed = 0
+    start = perf_counter()
+
+    for item in iterable:
+        elapsed += perf_counter() - start
+        yield item
+        start = perf_counter()
+
+    observe(elapsed + perf_counter() - start)
+
+async def iterate_threaded(iterable, executor=None, maxsize=4):
+    loop = get_running_loop()
+    queue = AsyncQueue(maxsize)
+    stop = Event()
+
+    def put(item):
+        run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            for item in iterable:
+                # blocks while the queue is full, which throttles the
+                # producer to the speed of the consumer
+                put((True, item))
+                if stop.is_set():
+                    return
+        except Exception as exc:
+            put((False, exc))
+        else:
+            put((False, None))
+
+    future = loop.run_in_executor(executor, produce)
+
+    try:
+        while True:
+            ok,item = await queue.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                break
+            yield item
+
+    finally:
+        # consumer is gone: tell the producer to stop and make room for
+        # the one item it might be blocked on
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+        await future
+
+# runs an async iterator in a task of its own for any number of
+# consumers; items are kept for consumers joining late only as long as
+# they add up to no more than limit, after that only the current
+# consumers get to see the rest
+#
+# the iterator is paced by its consumers: while items are kept it stays
+# up to window items ahead of the fastest one, afterwards ahead of the
+# slowest one, and it's closed once the last of them is gone
+class SharedIterator:
+    def __init__(self, iterator, limit, sizeof=len, window=4):
+        self.items = []
+        self.offset = 0
+        self.size = 0
+        self.limit = limit
+        self.sizeof = sizeof
+        self.window = window
+        self.kept = True
+        self.positions = {}
+        self.error = None
+        self.done = False
+        self.changed = AsyncEvent()
+        self.task = create_task(self.run(iterator))
+
+    @property
+    def end(self):
+        return self.offset + len(self.items)
+
+    @property
+    def joinable(self):
+        return self.kept
+
+    async def run(self, iterator):
+        try:
+            async for item in iterator:
+                self.items.append(item)
+
+                if self.kept:
+                    self.size += self.sizeof(item)
+                    if self.size > self.limit:
+                        self.kept = False
+                        self.trim()
+
+                self.wake()
+
+                while True:
+                    if not self.positions:
+                        if self.kept:
+                            break
+                        return
+
+                    pick = max if self.kept else min
+                    if self.end - pick(self.positions.values()) < self.window:
+                        break
+
+                    await self.changed.wait()
+
+        except Exception as exc:
+            self.error = exc
+
+        finally:
+            self.done = True
+            self.wake()
+            await iterator.aclose()
+
+    def wake(self):
+        changed,self.changed = self.changed,AsyncEvent()
+        changed.set()
+
+    def trim(self):
+        low = min(self.positions.values(), default=self.end)
+        del self.items[:low - self.offset]
+        self.offset = low
+
+    async def replay(self):
+        if not self.kept:
+            raise RuntimeError("Shared iterator no longer joinable")
+
+        token = object()
+        pos = self.positions[token] = 0
+
+        try:
+            while True:
+                while pos < self.end:
+                    item = self.items[pos - self.offset]
+                    pos = self.positions[token] = pos + 1
+                    if not self.kept:
+                        self.trim()
+                    self.wake()
+                    yield item
+
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+
+                await self.changed.wait()
+
+        finally:
+            del self.positions[token]
+            if not self.kept:
+                self.trim()
+            self.wake()
+
+def make_etag(*parts):
+    h = blake2b(digest_size=20, person=b'thincf.etag')
+    update_hash(h, *parts)
+    return f'"{h.hexdigest()}"'
+
+def etag_matches(if_none_match, etag):
+    return any(
+        tag.strip() in ('*', etag, f'W/{etag}')
+        for tag in if_none_match.split(',')
+    )
 
 def update_hash(h, *entries):
     for entry in entries:
@@ -136,6 +516,61 @@ def update_hash(h, *entries):
         h.update(entry)
         h.update(len(entry).to_bytes(4, 'big'))
 
+# bounded by number of entries and, given a sizeof function, by the sum
+# of their sizes
+class LRUCache:
+    def __init__(self, maxsize, maxage=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.sizeof is not None else 0
+
+        with self.lock:
+            if (old := self.items.pop(key, None)) is not None:
+                self.bytes -= old[2]
+
+            self.items[key] = (monotonic(), value, size)
+            self.bytes += size
+
+            while len(self.items) > self.maxsize or (
+                    self.maxbytes is not None and self.bytes > self.maxbytes):
+                _,(_,_,size) = self.items.popitem(last=False)
+                self.bytes -= size
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                stamp,value,size = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self.maxage is not None and monotonic() - stamp > self.maxage:
+                del self.items[key]
+                self.bytes -= size
+                self.misses += 1
+                return default
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
 class item:
     def __init__(self):
         self.values = []
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Compares the throughput of handing request body chunks to the tar
+# thread through ChunkReader against the previous approach of passing
+# every chunk through a queue.Queue bounded by a byte budget.
+#
+#   PYTHONPATH=server tests/bench_chunkreader.py [total MiB]
+
+from asyncio import get_running_loop,run
+from io import RawIOBase
+from os import environ
+from queue import Queue
+from sys import argv
+from time import perf_counter
+
+environ.setdefault('THINCF_SERVER_STATEDIR', '/')
+
+from thincf.server.util import ChunkReader
+
+CHUNK_SIZES = (256, 1024, 4096, 16384, 65536)
+READ_SIZE = 64 * 1024
+CAPACITY = 1024 * 1024
+
+class ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiter = None
+
+    async def acquire(self, size):
+        while self.used and self.used + size > self.limit:
+            self.waiter = get_running_loop().create_future()
+            await self.waiter
+        self.used += size
+
+    def release(self, size):
+        self.used -= size
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+class QueueChunkReader(RawIOBase):
+    def __init__(self, get_next_chunk):
+        self.get_next_chunk = get_next_chunk
+        self.cur = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self.cur:
+            if not (cur := self.get_next_chunk()):
+                return 0
+            self.cur = memoryview(cur)
+        front,self.cur = self.cur[:len(buf)],self.cur[len(buf):]
+        buf[:len(front)] = front
+        return len(front)
+
+def consume(reader):
+    total = 0
+    while data := reader.read(READ_SIZE):
+        total += len(data)
+    return total
+
+async def bench_queue(chunk, count):
+    loop = get_running_loop()
+    budget = ByteBudget(CAPACITY)
+    bq = Queue()
+
+    def get_next_chunk():
+        chunk = bq.get()
+        loop.call_soon_threadsafe(budget.release, len(chunk))
+        return chunk
+
+    thread = loop.run_in_executor(
+        None, consume, QueueChunkReader(get_next_chunk)
+    )
+    for _ in range(count):
+        await budget.acquire(len(chunk))
+        bq.put(chunk)
+    bq.put(b'')
+    return await thread
+
+async def bench_reader(chunk, count):
+    reader = ChunkReader(CAPACITY)
+    thread = get_running_loop().run_in_executor(None, consume, reader)
+    for _ in range(count):
+        await reader.write(chunk)
+    reader.finish()
+    return await thread
+
+async def main(total):
+    print(f"{'chunk':>8} {'queue MiB/s':>12} {'reader MiB/s':>12}")
+
+    for size in CHUNK_SIZES:
+        chunk = bytes(size)
+        count = total // size
+        results = []
+
+        for bench in (bench_queue, bench_reader):
+            start = perf_counter()
+            assert await bench(chunk, count) == count * size
+            results.append(count * size / (perf_counter() - start) / 2**20)
+
+        print(f"{size:>8} {results[0]:>12.1f} {results[1]:>12.1f}")
+
+if __name__ == '__main__':
+    run(main(int(argv[1] if len(argv) > 1 else 64) * 2**20))
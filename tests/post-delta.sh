@@ -0,0 +1,29 @@
+#!/bin/sh
+#
+# Uploads only the files of the state tree that the server's current
+# state lacks: the manifest of the whole tree is sent first and answered
+# with the paths the server needs, which are then uploaded together with
+# the manifest against the server's current state as base.
+
+set -e
+
+state="$(dirname "$(realpath "${0}")")/state"
+url=http://127.0.0.1:8000
+tmp=$(mktemp -d)
+trap 'rm -rf "${tmp}"' EXIT
+
+( cd "${state}" && find . -type f -exec sha256sum {} + ) \
+    > "${tmp}/.thincf-manifest"
+
+curl -sf -X POST -H "thincf-client: client" \
+     -D "${tmp}/headers" -o "${tmp}/needed" \
+     --data-binary @"${tmp}/.thincf-manifest" \
+     ${url}/manifest
+
+base=$(sed -n 's/^thincf-base: *//Ip' "${tmp}/headers" | tr -d '\r')
+
+tar -cf - -C "${state}" -T "${tmp}/needed" \
+          -C "${tmp}" .thincf-manifest | \
+    curl -X POST -H "thincf-client: client" -H "thincf-base: ${base}" \
+         --data-binary @- \
+         ${url}/